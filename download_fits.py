@@ -4,44 +4,38 @@ Will write the fits files into a directory structure under ./catalogue/download/
 """
 from pathlib import Path
 import argparse
+import os
 import json
+import shutil
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import lightkurve as lk
-from utility import iterate_targets
+from utility import iterate_targets, save_fits_metadata
 
-# Handle the command line args
-ap = argparse.ArgumentParser(description="Downloads lightcurve fits files for selected targets.")
-ap.add_argument(dest="input_file", type=Path, nargs="?",
-                help="The input file to read the targets from. Defaults to ./tessebs_extra.csv")
-ap.add_argument("-t", "--targets", dest="targets",
-                type=str, nargs="+", metavar="STAR", required=False,
-                help="Optional list of targets, within the input file, to restrict processing to")
-ap.add_argument("-m", "--mission", dest="mission", type=str, required=False,
-                help="The mission criterion for the lightcurve search [TESS]")
-ap.add_argument("-a", "--author", dest="author", type=str, required=False,
-                help="The author criterion for the lightcurve search [SPOC]")
-ap.add_argument("-e", "--exptime", dest="exptime", type=str, required=False,
-                help="The exposure time criterion for the lightcurce search [short]")
-ap.add_argument("-o", "--overwrite", dest="overwrite", required=False, action="store_true",
-                help="force re-download, potentially overwriting any previous downloaded files")
-ap.set_defaults(input_file=Path(".") / "tessebs_extra.csv",
-                targets=[],
-                mission="TESS",
-                author="SPOC",
-                exptime="short",
-                overwrite=False)
-args = ap.parse_args()
-if args.exptime.isdecimal(): # support numeric exptime values too
-    args.exptime = int(args.exptime)
-
-catalogue_dir = Path(".") / "catalogue"
-catalogue_dir.mkdir(parents=True, exist_ok=True)
-empty_targets = []
-
-print(f"Reading targets from {args.input_file}")
-for counter, (target, target_row, count_rows) in enumerate(
-        iterate_targets(args.input_file, index_filter=args.targets, nan_to_none=True),
-        start=1):
+
+def download_target(counter: int,
+                    target: str,
+                    target_row: dict,
+                    count_rows: int,
+                    mission: str,
+                    author: str,
+                    exptime: any,
+                    overwrite: bool=False) -> bool:
+    """
+    Searches for and downloads the fits files for a single target system.
+
+    :counter: simple counter/index for the target for messages
+    :target: the name of the target
+    :target_row: the input data associated with the target
+    :count_rows: total number of targets being processed (for messages)
+    :mission: the mission search criterion
+    :author: the author search criterion
+    :exptime: the exposure time search criterion
+    :overwrite: whether to force re-download, overwriting any previously downloaded files
+    :returns: False if no assets were found for the target, otherwise True
+    """
+    # pylint: disable=too-many-arguments
     tic = target_row["TIC"]
     print(f"""
 ---------------------------------------------
@@ -49,38 +43,112 @@ Processing target {counter}/{count_rows}: {target}
 ---------------------------------------------""")
 
     # Directory based on the tic without leading zeros to match STAR SHADOW's naming
-    download_dir = catalogue_dir / f"download/{tic}/"
+    download_dir = Path(".") / "catalogue" / f"download/{tic}/"
     target_json = download_dir / "target.json"
-    if not args.overwrite and target_json.exists():
-        print("Assets have previously been downloaded and the overwrite flag is not set. Skipping.")
-    else:
-        if download_dir.exists():
-            # Remove any existing json | downloads so nothing left to coalesce with the new fits set
-            print("Clearing out any previously downloaded assets")
-            for path in (p for p in download_dir.glob("**/*") if p.is_file()):
-                path.unlink()
-
-        print(f"Searching for {args.mission}/{args.author}/{args.exptime} target:", target)
-        results = lk.search_lightcurve(target,
-                                       mission=args.mission,
-                                       author=args.author,
-                                       exptime=args.exptime)
-
-        print("The search yielded a", results)
-        if results:
-            # quality_bitmask=0 supresses messages about excluded cadences; not relevent here
-            lcs = results.download_all(download_dir=f"{download_dir}", quality_bitmask=0)
-            print(f"Downloaded {len(lcs)} asset(s)")
-            if len(lcs) == 0:
-                empty_targets.append(target)
-
-            # Write out the supplied target input metadata so we can refer to it when processing
-            # the assets. This also acts as "lock" indicating we've downloaded this one.
-            with open(target_json, mode="w", encoding="utf8") as fp:
-                json.dump({ "Star": target, **target_row }, fp, ensure_ascii=False, indent=2)
-        else:
-            print("No assets found for target:", target)
-            empty_targets.append(target)
-
-if empty_targets:
-    print("No assets found for the target(s):", ", ".join(empty_targets))
+    if not overwrite and target_json.exists():
+        print(f"{target}: Assets have previously been downloaded "
+              "and the overwrite flag is not set. Skipping.")
+        return True
+
+    if download_dir.exists():
+        # Remove any existing json | downloads so nothing left to coalesce with the new fits set.
+        # Removing the whole tree in one go saves walking it to find & delete each file in turn.
+        print(f"{target}: Clearing out any previously downloaded assets")
+        shutil.rmtree(download_dir)
+
+    print(f"{target}: Searching for {mission}/{author}/{exptime} target")
+    results = lk.search_lightcurve(target, mission=mission, author=author, exptime=exptime)
+
+    print(f"{target}: The search yielded a {results}")
+    if not results:
+        print(f"{target}: No assets found for target")
+        return False
+
+    # quality_bitmask=0 supresses messages about excluded cadences; not relevent here
+    lcs = results.download_all(download_dir=os.fspath(download_dir), quality_bitmask=0)
+    print(f"{target}: Downloaded {len(lcs)} asset(s)")
+
+    # The header metadata used to select sectors for analysis are already loaded into each LC's
+    # meta, so save them now rather than have the analysis re-open every fits to read them.
+    if all("PDC_TOT" in lc.meta and "PDC_NOI" in lc.meta for lc in lcs):
+        save_fits_metadata(download_dir / "sectors.json", [{
+            "file": os.fspath(Path(lc.meta["FILENAME"])),
+            "SECTOR": lc.meta["SECTOR"],
+            "PDC_TOT": lc.meta["PDC_TOT"],
+            "PDC_NOI": lc.meta["PDC_NOI"]
+        } for lc in lcs])
+
+    # Write out the supplied target input metadata so we can refer to it when processing
+    # the assets. This also acts as "lock" indicating we've downloaded this one.
+    with open(target_json, mode="w", encoding="utf8") as fp:
+        json.dump({ "Star": target, **target_row }, fp, ensure_ascii=False, indent=2)
+    return len(lcs) > 0
+
+# -------------------------------------------
+# Download master processing starts here
+# -------------------------------------------
+if __name__ == "__main__":
+
+    # Handle the command line args
+    DESCRIPTION = "Downloads lightcurve fits files for selected targets."
+    ap = argparse.ArgumentParser(description=DESCRIPTION)
+    ap.add_argument(dest="input_file", type=Path, nargs="?",
+                    help="The input file to read the targets from. Defaults to ./tessebs_extra.csv")
+    ap.add_argument("-t", "--targets", dest="targets",
+                type=str, nargs="+", metavar="STAR", required=False,
+                help="Optional list of targets, within the input file, to restrict processing to")
+    ap.add_argument("-m", "--mission", dest="mission", type=str, required=False,
+                    help="The mission criterion for the lightcurve search [TESS]")
+    ap.add_argument("-a", "--author", dest="author", type=str, required=False,
+                    help="The author criterion for the lightcurve search [SPOC]")
+    ap.add_argument("-e", "--exptime", dest="exptime", type=str, required=False,
+                    help="The exposure time criterion for the lightcurce search [short]")
+    ap.add_argument("-o", "--overwrite", dest="overwrite", required=False, action="store_true",
+                    help="force re-download, potentially overwriting any previous downloaded files")
+    ap.add_argument("-ps", "--pool-size", dest="pool_size", type=int, required=False,
+                    choices=range(1, 9), metavar="{1-8}",
+                    help="The maximum number of concurrent downloads, limited to 8 so as not "
+                         "to overload MAST [4]")
+    ap.set_defaults(input_file=Path(".") / "tessebs_extra.csv",
+                    targets=[],
+                    mission="TESS",
+                    author="SPOC",
+                    exptime="short",
+                    overwrite=False,
+                    pool_size=4)
+    args = ap.parse_args()
+    if args.exptime.isdecimal(): # support numeric exptime values too
+        args.exptime = int(args.exptime)
+
+    catalogue_dir = Path(".") / "catalogue"
+    catalogue_dir.mkdir(parents=True, exist_ok=True)
+
+    # The searches & downloads are network bound so we run several targets concurrently.
+    # These are on processes, not threads, as lightkurve's download_all() silences output by
+    # swapping out the process-wide sys.stdout, which isn't safe with overlapping downloads.
+    # The futures map back to their target so we can report on any failures. Any error is
+    # reported and swallowed, as it completes, so that a single failure doesn't end the run.
+    print(f"Reading targets from {args.input_file}")
+    with ProcessPoolExecutor(max_workers=args.pool_size) as executor:
+        futures = {
+            executor.submit(download_target, i, targ, row, tot,
+                            args.mission, args.author, args.exptime, args.overwrite): targ
+            for i, (targ, row, tot) in enumerate(
+                iterate_targets(args.input_file, index_filter=args.targets, nan_to_none=True),
+                start=1)
+        }
+        empty_targets = []
+        failed_targets = []
+        for future in as_completed(futures):
+            target = futures[future]
+            try:
+                if not future.result():
+                    empty_targets.append(target)
+            except Exception: # pylint: disable=broad-exception-caught
+                print(f"{target}: Failed with the following error\n{traceback.format_exc()}")
+                failed_targets.append(target)
+
+    if empty_targets:
+        print("No assets found for the target(s):", ", ".join(empty_targets))
+    if failed_targets:
+        print("Processing failed for the target(s):", ", ".join(failed_targets))
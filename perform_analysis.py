@@ -2,35 +2,70 @@
 Perform STAR SHADOW analysis on previously downloaded TESS timeseries fits files
 (using catalogue_download_fits.py) for the targets in tessebs_extra.csv
 """
+from typing import List, Union
 from pathlib import Path
 import argparse
+import os
 import math
+import heapq
+import traceback
+from operator import itemgetter
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
 from astropy.io import fits
 import star_shadow as sts
 
 from utility import iterate_targets, echo_analysis_log, parse_analysis_for_eclipses
+from utility import find_fits_files
+from utility import load_fits_metadata, save_fits_metadata, auto_pool_size, cap_pool_size
 
+CATALOGUE_DIR = Path(".") / "catalogue"
+DOWNLOAD_DIR = CATALOGUE_DIR / "download"
+ANALYSIS_DIR = CATALOGUE_DIR / "analysis"
 
-def fits_criteria(hdul):
+# A rough estimate of the memory needed by each concurrent STAR SHADOW analysis
+ANALYSIS_MEM_GB = 4
+
+
+def fits_criteria(fits_meta: dict) -> float:
     """
-    Suitability criteria applied to fits/LC files (via their HDU lists).
+    Suitability criteria applied to fits/LC files (via their header metadata).
     Returns a single numeric value for the suitability; higher is better.
     """
-    pdc_tot = hdul[1].header["PDC_TOT"] # PDC Total goodness metric for target
-    pdc_noi = hdul[1].header["PDC_NOI"] # PDC Noise goodness metric for target
+    pdc_tot = fits_meta["PDC_TOT"] # PDC Total goodness metric for target
+    pdc_noi = fits_meta["PDC_NOI"] # PDC Noise goodness metric for target
 
     # Basic metric is based on PDC_TOT but we penalize high PDC_NOI (>.99)
     # as (based on inspection) these often have noise swamping any signal.
     return pdc_tot / (1 if pdc_noi <= 0.99 else 100)
 
+def read_fits_metadata(fits_file: str) -> dict:
+    """
+    Reads the header metadata needed to select and order a fits/LC file.
+    Only the primary and lightcurve headers are read; the data are not loaded.
+
+    :fits_file: the fits file to read
+    :returns: a dict of the file name and its SECTOR, PDC_TOT & PDC_NOI values
+    """
+    # A single open for both headers; no memmap & closed on exit so no handles are left behind.
+    # With lazy loading only the HDUs we index are read, so the remaining extensions are skipped.
+    with fits.open(fits_file, memmap=False, lazy_load_hdus=True) as hdul:
+        return {
+            "file": fits_file,
+            "SECTOR": hdul[0].header["SECTOR"],
+            "PDC_TOT": hdul[1].header["PDC_TOT"],
+            "PDC_NOI": hdul[1].header["PDC_NOI"]
+        }
+
 def analyse_target(counter: int,
                    target: str,
                    target_row: dict,
                    count_rows: int,
+                   fits_files: List[str],
                    overwrite_analysis: bool=False,
-                   simulate: bool=False) -> None:
+                   simulate: bool=False,
+                   quiet: bool=False) -> None:
     """
     Performs full STAR_SHADOW analysis on a single target system.
 
@@ -38,8 +73,10 @@ def analyse_target(counter: int,
     :target: the name of the target
     :target_row: the input data associated with the target
     :total_rows: total number of targets being processed (for messages)
+    :fits_files: the fits files previously downloaded for this target
     :overwrite_analysis: whether to force the analysis to overwrite previous results
     :simulate: report on the actions to be taken; do everything except STAR SHADOW analysis
+    :quiet: skip echoing the analysis log & eclipse parameters to the console once done
     """
     tic = target_row["TIC"]
     period = target_row["Period"]
@@ -49,24 +86,22 @@ Processing target {counter}/{count_rows}: {target}
 ---------------------------------------------""")
     print(f"{target}: Input catalogue gives the period as {period} d.")
 
-    # Directories based on the tic without leading zeros to match STAR SHADOW's naming
-    catalogue_dir = Path(".") / "catalogue"
-    analysis_dir = catalogue_dir / "analysis"
-    analysis_dir.mkdir(parents=True, exist_ok=True)
-    download_dir = catalogue_dir / f"download/{tic}/"
+    # Directory based on the tic without leading zeros to match STAR SHADOW's naming
+    download_dir = DOWNLOAD_DIR / f"{tic}"
 
     # Use the existance of the {tic}_analysis/{tic}_analysis_summary.csv as a lock
     # Note: STAR_SHADOW uses the numeric TIC without leading zeros in dir/file names.
-    analysis_csv = analysis_dir / f"{tic}_analysis" / f"{tic}_analysis_summary.csv"
+    analysis_csv = ANALYSIS_DIR / f"{tic}_analysis" / f"{tic}_analysis_summary.csv"
     if not overwrite_analysis and analysis_csv.exists():
         # sts won't restart a completed analysis unless overwrite=True so this
         # check isn't entirely necessary but it does make the console log clearer.
         print(f"{target}: A completed analysis exists.",
                "The overwrite flag isn't set so will not re-analyse.")
     else:
-        # All the fits previously downloaded for this target
-        fits_files = sorted(f"{f}" for f in download_dir.glob("**/*.fits"))
         print(f"{target}: Found {len(fits_files)} downloaded fits file(s) for this target.")
+        if not fits_files:
+            print(f"{target}: There is nothing to analyse. Skipping.")
+            return
 
         # As an optimization avoid using all (potentially 30+) fits for the analysis.
         # We choose the max sectors based on the period so with increasing period more
@@ -76,11 +111,19 @@ Processing target {counter}/{count_rows}: {target}
         # As we're not using all the sectors we need to choose the ones most likely
         # to yield a good analysis. Each sector's metadata are assessed with the
         # fits_criteria() call with the top(N) best performing sectors selected.
-        hduls = sorted((fits.open(f) for f in fits_files), key=fits_criteria, reverse=True)[:top_n]
+        # The metadata don't change so they're saved for reuse on any subsequent runs.
+        sectors_json = download_dir / "sectors.json"
+        fits_metas = load_fits_metadata(sectors_json, fits_files)
+        if fits_metas is None:
+            # Reading the headers is I/O bound so we overlap the reads with a few threads.
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                fits_metas = list(executor.map(read_fits_metadata, fits_files))
+            save_fits_metadata(sectors_json, fits_metas)
+        fits_metas = heapq.nlargest(top_n, fits_metas, key=fits_criteria)
 
         # Finally get things back into sector order for processing by STAR_SHADOW
-        hduls = sorted(hduls, key=lambda hdul: hdul[0].header["SECTOR"])
-        use_fits, use_sectors = zip(*[(h.filename(), h[0].header["SECTOR"]) for h in hduls])
+        fits_metas.sort(key=itemgetter("SECTOR"))
+        use_fits, use_sectors = zip(*[(m["file"], m["SECTOR"]) for m in fits_metas])
 
         # With overwrite=False this appears to be able to resume from last
         # completed stage. Set overwrite=True to restart the analysis anyway.
@@ -95,15 +138,31 @@ Processing target {counter}/{count_rows}: {target}
                                     stage='all',
                                     method='fitter',
                                     data_id=target,
-                                    save_dir=f"{analysis_dir}",
+                                    save_dir=os.fspath(ANALYSIS_DIR),
                                     overwrite=overwrite_analysis,
                                     verbose=True)
 
-    if not simulate:
+    if not simulate and not quiet:
         # Echo the log and selected eclipse parameters to the console.
         echo_analysis_log(analysis_csv.parent / f"{tic}.log")
         parse_analysis_for_eclipses(analysis_csv, verbose=True)
 
+def analyse_target_with_prms(prms: tuple) -> Union[str, None]:
+    """
+    Calls analyse_target() with the parameters held in the passed tuple.
+    For use with Pool.imap_unordered() which, unlike starmap(), takes single argument functions.
+    Any error is reported and swallowed so that a single failure doesn't end the whole run.
+
+    :prms: the tuple of analyse_target() parameters
+    :returns: None if the target was processed, otherwise the name of the failed target
+    """
+    try:
+        analyse_target(*prms)
+        return None
+    except Exception: # pylint: disable=broad-exception-caught
+        print(f"{prms[1]}: Failed with the following error\n{traceback.format_exc()}")
+        return prms[1]
+
 # -------------------------------------------
 # Analysis master processing starts here
 # -------------------------------------------
@@ -120,28 +179,62 @@ if __name__ == "__main__":
     ap.add_argument("-o", "--overwrite", dest="overwrite", required=False, action="store_true",
                     help="force re-analysis, overwriting any previous results")
     ap.add_argument("-ps", "--pool-size", dest="pool_size", type=int, required=False,
-                    help="The maximum number of concurrent analyses to run [1]")
+                    help="The maximum number of concurrent analyses to run or 0 to size "
+                         "the pool to the available CPUs and memory [1]")
     ap.add_argument("-simulate", "--simulate", dest="simulate", required=False, action="store_true",
                     help="Report on what actions will be carried out without performing them")
+    ap.add_argument("-q", "--quiet", dest="quiet", required=False, action="store_true",
+                    help="Do not echo each target's analysis log and eclipse parameters")
     ap.set_defaults(input_file=Path(".") / "tessebs_extra.csv",
                     targets=[],
                     overwrite=False,
                     pool_size=1,
-                    simulate=False)
+                    simulate=False,
+                    quiet=False)
     args = ap.parse_args()
+    if args.pool_size == 0:
+        # The auto size only considers CPUs, so it too has to be capped for the available memory
+        args.pool_size = cap_pool_size(auto_pool_size(), ANALYSIS_MEM_GB)
+        print(f"Sized the pool to {args.pool_size} process(es)",
+              "based on the available CPUs and memory")
+    elif args.pool_size > 1:
+        # Too large a pool will thrash or run out of memory, so cap it to what we can support
+        pool_size = cap_pool_size(args.pool_size, ANALYSIS_MEM_GB)
+        if pool_size < args.pool_size:
+            print(f"Reduced the pool size from {args.pool_size} to {pool_size} process(es)",
+                  "based on the available CPUs and memory")
+            args.pool_size = pool_size
+
+    # Set up the output directory once here, rather than on every analyse_target call
+    ANALYSIS_DIR.mkdir(parents=True, exist_ok=True)
 
-    # For the analyse_target calls, starmap requires an iterator over the sorted params
-    # in the form [(1, targ1, row1, total, ow), (2, targ2, row2, total, ow), ...]
     print(f"Reading targets from {args.input_file}")
-    iter_prms = (
-        (i, targ, row, tot, args.overwrite, args.simulate) for i, (targ, row, tot) in enumerate(
-            iterate_targets(args.input_file, index_filter=args.targets),
+
+    # For the analyse_target calls we require a list of the sorted params in the form
+    # [(1, targ1, row1, total, fits1, ow, sim, quiet), (2, targ2, row2, total, fits2, ...), ...]
+    # This is built up front so the targets are read & sorted, and their fits found, once here
+    # rather than from the pool's task feeder thread or within the workers. The fits are in dirs
+    # named on the tic without leading zeros, to match STAR SHADOW's naming. When pooled, the
+    # targets are ordered longest period first as the number of sectors analysed (and so the
+    # time taken) increases with the period; starting these first stops one of them holding up
+    # the end of the run.
+    iter_prms = [
+        (i, targ, row, tot, find_fits_files(DOWNLOAD_DIR / f"{row['TIC']}"),
+         args.overwrite, args.simulate, args.quiet)
+        for i, (targ, row, tot) in enumerate(
+            iterate_targets(args.input_file, index_filter=args.targets,
+                            sort_by="-Period" if args.pool_size > 1 else None),
             start=1)
-    )
+    ]
 
     if args.pool_size <= 1: # We could use a pool of 1, but keep execution on the interactive proc
-        for prms in iter_prms:
-            analyse_target(*prms)
+        failed_targets = [analyse_target_with_prms(prms) for prms in iter_prms]
     else:
+        # imap_unordered hands out each target as soon as a worker becomes free
         with Pool(args.pool_size) as pool:
-            pool.starmap(analyse_target, iter_prms, chunksize=1)
+            failed_targets = list(
+                pool.imap_unordered(analyse_target_with_prms, iter_prms, chunksize=1))
+
+    failed_targets = [t for t in failed_targets if t]
+    if failed_targets:
+        print("Processing failed for the target(s):", ", ".join(failed_targets))
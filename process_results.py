@@ -2,102 +2,211 @@
 Uses the results of STAR SHADOW analysis, especially eclipse timing and contact
 points, to set up eclipse masks and subsequently flatten catelogue light-curves.
 """
+from typing import List, Tuple
 from pathlib import Path
 import argparse
+import os
+from contextlib import nullcontext
+from multiprocessing import Pool
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg") # Non-interactive backend; we only save plots & it is safe for pooled use
+from matplotlib.image import imsave
 import lightkurve as lk
+from uncertainties import UFloat
 
-from utility import iterate_targets
+from utility import iterate_targets, find_fits_files
 from utility import echo_analysis_log, parse_analysis_for_eclipses, lookup_tess_ebs_ephemeris
 from utility import flatten_lightcurve, plot_lightcurves_and_mask
-from utility import calculate_variability_metric
-
-# Handle the command line args
-DESCRIPTION = "Calculates the variability metrics for the target systems in the input file."
-ap = argparse.ArgumentParser(description=DESCRIPTION)
-ap.add_argument(dest="input_file", type=Path, nargs="?",
-                help="The input file to read the targets from. Defaults to ./tessebs_extra.csv")
-ap.add_argument("-t", "--targets", dest="targets",
+from utility import calculate_variability_metric, auto_pool_size
+
+
+# Light png compression; much quicker to save than the default level (6) for slightly larger files
+PNG_PIL_KWARGS = { "compress_level": 1 }
+
+# The axes of the figure each process reuses for its plots, rather than creating one per sector
+plot_axes = None
+
+def process_sector(fits_file: str,
+                   flux_column: str,
+                   quality_bitmask: any,
+                   ecl_times: List[UFloat],
+                   ecl_durs: List[UFloat],
+                   period: UFloat,
+                   target: str,
+                   tic: int,
+                   plot_to: Path=None,
+                   save_executor: Executor=None,
+                   save_futures: List[Future]=None) -> Tuple[int, float]:
+    """
+    Processes a single sector's light curve, calculating its variability metric and
+    optionally saving plots of the light curves.
+
+    :fits_file: the sector's light curve fits file
+    :flux_column: the flux column to read
+    :quality_bitmask: the quality bitmask to apply to the light curve
+    :ecl_times: reference central times for the eclipse masks
+    :ecl_durs: eclipse durations for the the eclipse masks
+    :period: the orbital period of the system
+    :target: the name of the target
+    :tic: the numeric TIC of the target
+    :plot_to: optional root directory to save the plots to; no plots if omitted
+    :save_executor: optional executor on which to encode & write the plots to png in the background
+    :save_futures: list to which the futures of any background saves are appended, so the
+    caller can wait on them and pick up any failures
+    :returns: a tuple of (sector, variability)
+    """
+    # pylint: disable=too-many-arguments, global-statement
+    global plot_axes
+    lc = lk.read(os.fspath(fits_file), flux_column=flux_column, quality_bitmask=quality_bitmask)
+    sector = lc.meta["SECTOR"]
+
+    # Process the light curve
+    lc = lc.normalize()
+    flat_lc, res_flux, ecl_mask = flatten_lightcurve(lc, ecl_times, ecl_durs, period)
+    variability = calculate_variability_metric(res_flux)
+
+    # Plots
+    if plot_to:
+        plot_file = plot_to / f"{tic}/{target}_{sector:03d}.png"
+        plot_file.parent.mkdir(parents=True, exist_ok=True)
+        title = f"{lc.meta['OBJECT']} sector {sector:03d} (variability = {variability:.6f})"
+        fig, plot_axes = plot_lightcurves_and_mask(lc, flat_lc, res_flux, ecl_mask, (8, 6), title,
+                                                   plot_axes)
+        if save_executor:
+            # The figure is reused so has to be rendered now, but the png compression and write
+            # of a copy of the rendered image can be left to the executor as we move on.
+            fig.set_dpi(100)
+            fig.canvas.draw()
+            future = save_executor.submit(imsave, plot_file, np.array(fig.canvas.buffer_rgba()),
+                                          dpi=100, pil_kwargs=PNG_PIL_KWARGS)
+            if save_futures is not None:
+                save_futures.append(future)
+        else:
+            fig.savefig(plot_file, dpi=100, pil_kwargs=PNG_PIL_KWARGS)
+
+    return sector, variability
+
+
+def process_sector_with_prms(prms: tuple) -> Tuple[int, float]:
+    """
+    Calls process_sector() with the parameters held in the passed tuple.
+    For use with Pool.imap_unordered() which, unlike starmap(), takes single argument functions.
+
+    :prms: the tuple of process_sector() parameters
+    :returns: a tuple of (sector, variability)
+    """
+    return process_sector(*prms)
+
+
+# -------------------------------------------
+# Results master processing starts here
+# -------------------------------------------
+if __name__ == "__main__":
+
+    # Handle the command line args
+    DESCRIPTION = "Calculates the variability metrics for the target systems in the input file."
+    ap = argparse.ArgumentParser(description=DESCRIPTION)
+    ap.add_argument(dest="input_file", type=Path, nargs="?",
+                    help="The input file to read the targets from. Defaults to ./tessebs_extra.csv")
+    ap.add_argument("-t", "--targets", dest="targets",
                 type=str, nargs="+", metavar="STAR", required=False,
                 help="Optional list of targets, within the input file, to restrict processing to")
-ap.add_argument("-fc", "--flux-column", dest="flux_column", type=str, required=False,
-                choices=["sap_flux", "pdcsap_flux"], help="The flux_column to use [pdcsap_flux]")
-ap.add_argument("-qb", "--quality-bitmask", dest="quality_bitmask", type=str, required=False,
-                help="An optional quality bitmask to apply to the lightcurves. Defaults to hardest")
-ap.add_argument("-p", "--plot", dest="plot_to", type=Path, required=False,
-                nargs="?", const=Path(".") / "catalogue" / "plots", metavar="PATH",
-                help="Save plots for each target sector and optionally where to save them")
-ap.set_defaults(input_file=Path(".") / "tessebs_extra.csv",
-                targets=[],
-                flux_column="pdcsap_flux",
-                quality_bitmask="default",
-                plot_to=None)
-args = ap.parse_args()
-if args.quality_bitmask.isdecimal(): # support numeric quality_bitmask values too
-    args.quality_bitmask = int(args.quality_bitmask)
-
-catalogue_dir = Path(".") / "catalogue"
-analysis_dir = catalogue_dir / "analysis"
-analysis_dir.mkdir(parents=True, exist_ok=True)
-
-print(f"Reading targets from {args.input_file}")
-for counter, (target, target_row, count_rows) in enumerate(
-        iterate_targets(args.input_file, index_filter=args.targets),
-        start=1):
-    tic = target_row["TIC"]
-    print(f"""
+    ap.add_argument("-fc", "--flux-column", dest="flux_column", type=str, required=False,
+                    choices=["sap_flux", "pdcsap_flux"],
+                    help="The flux_column to use [pdcsap_flux]")
+    ap.add_argument("-qb", "--quality-bitmask", dest="quality_bitmask", type=str, required=False,
+                    help="An optional quality bitmask to apply to the lightcurves [default]")
+    ap.add_argument("-p", "--plot", dest="plot_to", type=Path, required=False,
+                    nargs="?", const=Path(".") / "catalogue" / "plots", metavar="PATH",
+                    help="Save plots for each target sector and optionally where to save them")
+    ap.add_argument("-ps", "--pool-size", dest="pool_size", type=int, required=False,
+                    help="The maximum number of sectors to process concurrently or 0 to size "
+                         "the pool to the available CPUs [1]")
+    ap.set_defaults(input_file=Path(".") / "tessebs_extra.csv",
+                    targets=[],
+                    flux_column="pdcsap_flux",
+                    quality_bitmask="default",
+                    plot_to=None,
+                    pool_size=1)
+    args = ap.parse_args()
+    if args.pool_size == 0:
+        args.pool_size = auto_pool_size()
+        print(f"Sized the pool to {args.pool_size} process(es) based on the available CPUs")
+    if args.quality_bitmask.isdecimal(): # support numeric quality_bitmask values too
+        args.quality_bitmask = int(args.quality_bitmask)
+
+    catalogue_dir = Path(".") / "catalogue"
+    analysis_dir = catalogue_dir / "analysis"
+    analysis_dir.mkdir(parents=True, exist_ok=True)
+
+    # Any pool of sector workers is set up once and reused for each target. We could use
+    # a pool of 1, but instead keep execution on the interactive proc if there's no pool.
+    # Without a pool, plots are saved on a background thread so the next sector can get going.
+    # Not used with a pool; workers may be terminated with saves pending & the pool overlaps them.
+    with Pool(args.pool_size) if args.pool_size > 1 else nullcontext() as pool, \
+            ThreadPoolExecutor(max_workers=2) if not pool and args.plot_to else nullcontext() \
+                as save_executor:
+        print(f"Reading targets from {args.input_file}")
+        for counter, (target, target_row, count_rows) in enumerate(
+                iterate_targets(args.input_file, index_filter=args.targets),
+                start=1):
+            tic = target_row["TIC"]
+            print(f"""
 ---------------------------------------------
 Processing target {counter}/{count_rows}: {target}
 ---------------------------------------------""")
 
-    # Use the existance of the output/analysis*/*_analysis_summary.csv as a lock
-    analysis_csv = analysis_dir / f"{tic}_analysis" / f"{tic}_analysis_summary.csv"
-    if not analysis_csv.exists():
-        print(f"Did not find '{analysis_csv}'. Unable to process {target}. Skipping.")
-    else:
-        echo_analysis_log(analysis_csv.parent / f"{tic}.log")
-        (t0, period, ecl_times, ecl_durs) = parse_analysis_for_eclipses(analysis_csv)
-        if t0 is None or t0 <= 0.:
-            t0, _ = lookup_tess_ebs_ephemeris(target, tic)
-            if t0 and t0 > 0.:
-                print(f"Analysis didn't find a reference time so using {t0:.6f} from TESS-ebs.")
-                ecl_times = [et + t0 for et in ecl_times]
-
-        # Directories based on the tic without leading zeros to match STAR SHADOW's naming
-        download_dir = catalogue_dir / f"download/{tic}/"
-        target_json = download_dir / "target.json"
-
-        fits = sorted(download_dir.rglob("**/*.fits"))
-        lcs = lk.LightCurveCollection([
-            lk.read(f"{f}", flux_column=args.flux_column, quality_bitmask=args.quality_bitmask)
-                for f in fits])
-        print(f"\nLoaded {len(lcs)} light curve fits file(s) for", target)
-
-        variabilities = []
-        for lc in lcs:
-            sector = lc.meta["SECTOR"]
-
-            # Process the light curve
-            lc = lc.normalize()
-            flat_lc, res_lc, ecl_mask = flatten_lightcurve(lc, ecl_times, ecl_durs, period)
-            variability = calculate_variability_metric(res_lc)
-            variabilities.append(variability)
-            print(f"Processed sector {sector:03d} {args.flux_column}",
-                  f"and calculated its variability metric to be {variability:.6f}")
-
-            # Plots
-            if args.plot_to:
-                plot_file = args.plot_to / f"{tic}/{target}_{sector:03d}.png"
-                plot_file.parent.mkdir(parents=True, exist_ok=True)
-                title = f"{lc.meta['OBJECT']} sector {sector:03d} (variability = {variability:.6f})"
-                fig, _ = plot_lightcurves_and_mask(lc, flat_lc, res_lc, ecl_mask, (8, 6), title)
-                fig.savefig(plot_file, dpi=100)
-                plt.close(fig)
-
-        # Calculating the variability by sector & taking the mean/stddev appears
-        # more reliable than stitching the res_lcs and calculating the metric directly.
-        # The stitched resids suffer from large discursions absent from the source lcs.
-        print("\nThe overall variability metric =",
-              f"{np.mean(variabilities):.6f}+/-{np.std(variabilities):.6f}\n")
+            # Use the existance of the output/analysis*/*_analysis_summary.csv as a lock
+            analysis_csv = analysis_dir / f"{tic}_analysis" / f"{tic}_analysis_summary.csv"
+            if not analysis_csv.exists():
+                print(f"Did not find '{analysis_csv}'. Unable to process {target}. Skipping.")
+            else:
+                echo_analysis_log(analysis_csv.parent / f"{tic}.log")
+                (t0, period, ecl_times, ecl_durs) = \
+                    parse_analysis_for_eclipses(analysis_csv, use_cache=True)
+                if t0 is None or t0 <= 0.:
+                    t0, _ = lookup_tess_ebs_ephemeris(target, tic)
+                    if t0 and t0 > 0.:
+                        print("Analysis didn't find a reference time so using",
+                              f"{t0:.6f} from TESS-ebs.")
+                        ecl_times = [et + t0 for et in ecl_times]
+
+                # Directories based on the tic without leading zeros to match STAR SHADOW's naming
+                download_dir = catalogue_dir / f"download/{tic}/"
+                target_json = download_dir / "target.json"
+
+                fits = find_fits_files(download_dir)
+                print(f"\nFound {len(fits)} light curve fits file(s) for", target)
+
+                # The sectors are independent of each other so may be processed concurrently
+                save_futures = []
+                iter_prms = ((f, args.flux_column, args.quality_bitmask,
+                              ecl_times, ecl_durs, period, target, tic, args.plot_to)
+                                for f in fits)
+                if pool:
+                    # Sectors take similar times to process so they can be handed out in
+                    # chunks, cutting the IPC round trips while keeping the workers balanced.
+                    chunksize = max(1, len(fits) // (args.pool_size * 2))
+                    results = pool.imap_unordered(process_sector_with_prms, iter_prms, chunksize)
+                else:
+                    results = (process_sector(*prms, save_executor, save_futures)
+                                    for prms in iter_prms)
+
+                variabilities = []
+                for sector, variability in results:
+                    variabilities.append(variability)
+                    print(f"Processed sector {sector:03d} {args.flux_column}",
+                          f"and calculated its variability metric to be {variability:.6f}")
+
+                # Wait for this target's background plot saves, raising any which failed
+                for future in save_futures:
+                    future.result()
+
+                # Calculating the variability by sector & taking the mean/stddev appears
+                # more reliable than stitching the res_lcs and calculating the metric directly.
+                # The stitched resids suffer from large discursions absent from the source lcs.
+                print("\nThe overall variability metric =",
+                      f"{np.mean(variabilities):.6f}+/-{np.std(variabilities):.6f}\n")
@@ -1,14 +1,20 @@
 """ Helper functions for the platodebs project. """
-from typing import List, Tuple, Union
+from typing import List, Tuple, Dict, Union
 from pathlib import Path
+from functools import lru_cache
+import os
+import math
+import json
 
-from scipy.stats import iqr
 import numpy as np
+from numba import njit
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.axes import Axes
+from matplotlib.collections import PolyCollection
 
+import psutil
 from uncertainties import ufloat, UFloat
 from lightkurve import LightCurve
 from astroquery.vizier import Vizier
@@ -31,26 +37,169 @@ def iterate_targets(input_csv: Path,
     :nan_to_none: whether to substitute None for NaN values
     :returns: yields a tuple of the index value, row dict and total row count
     """
-    input_df = pd.read_csv(input_csv, index_col=index_col, sep=",", header=0)
-    if nan_to_none:
-        input_df.replace({ np.nan: None }, inplace=True)
+    # The parsed csv is cached & shared between calls so it must not be modified in place
+    input_df = read_targets_csv(os.fspath(input_csv), index_col, Path(input_csv).stat().st_mtime_ns)
 
     if index_filter and len(index_filter) > 0:
         input_df = input_df[input_df.index.isin(index_filter)]
 
     if sort_by:
-        if sort_by.startswith("-"):
-            sort_by = sort_by.strip("-")
-            ascending = False
-        else:
-            sort_by = sort_by.strip("+")
-            ascending = True
-        input_df.sort_values(by=sort_by, ascending=ascending, inplace=True)
+        # The NaNs are left in place, so this sorts on the columns' native (not object) dtypes
+        sort_col, ascending = parse_sort_by(sort_by)
+        input_df = input_df.sort_values(by=sort_col, ascending=ascending)
 
+    # itertuples avoids the cost of iterrows() building a Series for each row
     count = len(input_df)
-    for index, row in input_df.iterrows():
+    columns = input_df.columns.tolist()
+    for index, *values in input_df.itertuples(index=True, name=None):
+        if nan_to_none:
+            # Only the rows yielded are touched, rather than replacing across the whole DataFrame
+            values = [None if isinstance(v, float) and math.isnan(v) else v for v in values]
         # Return the row as a dict so client need know nothing of how we do this
-        yield index, row.to_dict(), count
+        yield index, dict(zip(columns, values)), count
+
+
+def parse_sort_by(sort_by: str) -> Tuple[str, bool]:
+    """
+    Parses a sort_by argument, a column name optionally prefixed with + or - for an
+    ascending or descending sort, into the column name and the sort direction.
+
+    :sort_by: the sort column; prefix with + or - for asc/descending sort
+    :returns: a tuple of (column name, ascending)
+    """
+    if sort_by.startswith("-"):
+        return sort_by.strip("-"), False
+    return sort_by.strip("+"), True
+
+
+@lru_cache(maxsize=8)
+def read_targets_csv(input_csv: str, index_col: str, mtime_ns: int) -> pd.DataFrame:
+    """
+    Reads the targets csv file into a DataFrame, caching the result so that subsequent
+    iterate_targets() calls over the same file don't have to parse it again.
+    The returned DataFrame is shared between callers so should be treated as read-only.
+
+    :input_csv: the input csv file
+    :index_col: the name of the csv column to index on
+    :mtime_ns: the file's modified time, so that any change to the file misses the cache
+    :returns: the parsed csv
+    """
+    # pylint: disable=unused-argument
+    return pd.read_csv(input_csv, index_col=index_col, sep=",", header=0)
+
+
+def find_fits_files(root: Path) -> List[str]:
+    """
+    Finds all of the fits files within the root directory and its subdirectories.
+    Uses os.scandir() which, unlike Path.glob(), gets each entry's type without
+    needing to stat it.
+
+    :root: the directory to search
+    :returns: the sorted list of fits file paths, which is empty if root doesn't exist
+    """
+    if not os.path.isdir(root):
+        return []
+
+    fits_files = []
+    dirs = [root]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.path)
+                elif entry.name.endswith(".fits"):
+                    fits_files.append(entry.path)
+    return sorted(fits_files)
+
+
+def load_fits_metadata(metadata_json: Path, fits_files: List[str]) -> Union[List[dict], None]:
+    """
+    Will load previously saved fits header metadata, as long as it covers exactly
+    the given fits files and none of them have been modified since it was saved.
+
+    :metadata_json: the json file the metadata was saved to
+    :fits_files: the fits files we require the metadata for
+    :returns: the list of metadata dicts, in the order of fits_files, or None if
+    the json file was not found, is damaged or is out of date
+    """
+    try:
+        with open(metadata_json, mode="r", encoding="utf8") as fp:
+            metas = { m["file"]: m for m in json.load(fp) }
+        if metas.keys() != set(fits_files) \
+                or any(metas[f]["mtime"] != Path(f).stat().st_mtime for f in fits_files):
+            return None
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        # Missing or damaged (e.g. truncated or hand edited) metadata have to be re-read
+        return None
+    return [metas[f] for f in fits_files]
+
+
+def save_fits_metadata(metadata_json: Path, fits_metas: List[dict]) -> None:
+    """
+    Will save fits header metadata so that it may be reloaded with load_fits_metadata().
+    Each dict must have a "file" item. The file's modified time is saved alongside
+    so that we can tell if the saved metadata goes out of date.
+
+    :metadata_json: the json file to save the metadata to
+    :fits_metas: the list of metadata dicts to save
+    """
+    fits_metas = [{ **m, "mtime": Path(m["file"]).stat().st_mtime } for m in fits_metas]
+    save_json(metadata_json, fits_metas, ensure_ascii=False, indent=2)
+
+
+def save_json(json_file: Path, obj: any, **kwargs) -> None:
+    """
+    Will save the object to a json file. It is first written to a temporary file which then
+    replaces the json file, so an interrupted write cannot leave a truncated json file behind.
+
+    :json_file: the json file to save to
+    :obj: the object to save
+    :kwargs: any further arguments for json.dump()
+    """
+    temp_file = json_file.parent / f"{json_file.name}.{os.getpid()}.tmp"
+    try:
+        with open(temp_file, mode="w", encoding="utf8") as fp:
+            json.dump(obj, fp, **kwargs)
+        os.replace(temp_file, json_file)
+    finally:
+        if temp_file.exists():
+            temp_file.unlink()
+
+
+def auto_pool_size() -> int:
+    """
+    Gets the number of worker processes which may run concurrently without oversubscribing
+    the CPUs available to this process. Where OMP_NUM_THREADS is set each worker is assumed
+    to be running that many threads.
+
+    :returns: the pool size, which will be at least 1
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else: # sched_getaffinity() is not available on all platforms (e.g. macOS & Windows)
+        cpus = os.cpu_count() or 1
+
+    # OMP_NUM_THREADS may give a list of nested levels (e.g. 4,2), of which the first is the
+    # number of threads for each worker. Anything else unusable is treated as 1 thread.
+    try:
+        threads = int(os.environ.get("OMP_NUM_THREADS", "1").split(",")[0])
+    except ValueError:
+        threads = 1
+    return max(1, cpus // max(1, threads))
+
+
+def cap_pool_size(pool_size: int, proc_mem_gb: float) -> int:
+    """
+    Caps the requested pool size so that the pooled processes neither oversubscribe
+    the available CPUs (see auto_pool_size()) nor, given an estimate of each
+    process's memory requirement, exceed the memory currently available.
+
+    :pool_size: the requested pool size
+    :proc_mem_gb: the estimated memory requirement, in GB, of each pooled process
+    :returns: the capped pool size, which will be at least 1
+    """
+    mem_procs = int(psutil.virtual_memory().available / (proc_mem_gb * 1024**3))
+    return max(1, min(pool_size, auto_pool_size(), mem_procs))
 
 
 def echo_analysis_log(analysis_log: Path) -> None:
@@ -60,17 +209,19 @@ def echo_analysis_log(analysis_log: Path) -> None:
     :analysis_log: the input log file
     """
     print("Analysis Log:")
-    if not analysis_log.exists():
-        print("*** Not found ***")
-    else:
+    try:
         with (analysis_log).open(mode="r") as lf:
-            block = "\n".join(l.strip() for l in lf.readlines())
+            # One bulk read rather than building a list of the lines with readlines()
+            block = "\n".join(l.strip() for l in lf.read().splitlines())
             print(block)
+    except FileNotFoundError:
+        print("*** Not found ***")
 
 
 def parse_analysis_for_eclipses(analysis_csv: Path,
                                 duration_scale: float=1.,
-                                verbose: bool=True) \
+                                verbose: bool=True,
+                                use_cache: bool=False) \
         -> Union[Tuple[UFloat, UFloat, List[UFloat], List[UFloat]], None]:
     """
     Will parse a STAR_SHADOW analysis_summary csv file for the eclipse results.
@@ -78,19 +229,92 @@ def parse_analysis_for_eclipses(analysis_csv: Path,
     :analysis_csv: the path of the csv file to open.
     :duration_scale: an optional scaling multiplier to apply to the analysis eclipse durations
     :verbose: whether to print out eclipse details to the console
+    :use_cache: whether to save the parsed results to, and reuse them from, a json file
+    alongside the csv. The saved results are ignored if the csv has since been modified.
     :returns: a tuple in the form (reference_time, period, [eclipe_times], [eclipse_durations])
     or None if the analysis_summary csv was not found.
     """
-    if not analysis_csv.exists():
-        return None
+    def to_json(value: UFloat):
+        return [value.nominal_value, value.std_dev] if value is not None else None
+
+    def from_json(value: List[float]) -> UFloat:
+        return ufloat(*value) if value is not None else None
+
+    # We go straight to opening the files, handling their absence, rather than first checking
+    # they exist. A missing, orphaned (where the csv has gone) or damaged (e.g. truncated)
+    # cache is ignored & we fall through to reading the csv, which replaces the cache.
+    results = None
+    cache_json = analysis_csv.parent / f"{analysis_csv.stem}_eclipses.json"
+    if use_cache:
+        try:
+            if cache_json.stat().st_mtime >= analysis_csv.stat().st_mtime:
+                with open(cache_json, mode="r", encoding="utf8") as fp:
+                    cached = json.load(fp)
+                results = (from_json(cached["t0"]),
+                           from_json(cached["period"]),
+                           [from_json(t) for t in cached["eclipse_times"]],
+                           [from_json(t) for t in cached["eclipse_durations"]],
+                           cached["warnings"])
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+
+    if results is None:
+        try:
+            results = read_analysis_for_eclipses(analysis_csv)
+        except FileNotFoundError:
+            return None
+        if use_cache:
+            save_json(cache_json, {
+                "t0": to_json(results[0]),
+                "period": to_json(results[1]),
+                "eclipse_times": [to_json(t) for t in results[2]],
+                "eclipse_durations": [to_json(t) for t in results[3]],
+                "warnings": results[4]
+            }, indent=2)
+    t0, period, eclipse_times, eclipse_durations, warnings = results
+
+    if duration_scale != 1.:
+        eclipse_durations = [t * duration_scale for t in eclipse_durations]
+
+    if verbose:
+        for warning in warnings:
+            print(warning)
+        print(f"From {analysis_csv.name}")
+        print( "Reference time:             ", (f"{t0:.6f}" if t0 else ""))
+        print( "Orbital period:             ", (f"{period:.6f}" if period else ""))
+        print( "Eclipse times:              ", ", ".join(f"{t:.6f}" for t in eclipse_times))
+        print( "Eclipse durations:          ", ", ".join(f"{t:.6f}" for t in eclipse_durations))
+        if duration_scale != 1.:
+            print(f"Eclipse durations scaled by: {duration_scale}")
+        if any(t.nominal_value == 0 for t in eclipse_durations):
+            print("At least one eclipse duration is zero. Were eclipses found?")
+
+    return t0, period, eclipse_times, eclipse_durations
+
 
-    smry = pd.read_csv(analysis_csv, sep=",", skiprows=2,
-                       names=["name", "val", "desc"], index_col="name")
+def read_analysis_for_eclipses(analysis_csv: Path) \
+        -> Tuple[UFloat, UFloat, List[UFloat], List[UFloat], List[str]]:
+    """
+    Will read the unscaled eclipse results from a STAR_SHADOW analysis_summary csv file.
+    Generally, parse_analysis_for_eclipses() should be used in preference to this.
+
+    :analysis_csv: the path of the csv file to open.
+    :returns: a tuple in the form
+    (reference_time, period, [eclipe_times], [eclipse_durations], [warnings]) where the
+    warnings describe any problems with the eclipse details
+    """
+    # We only need simple lookups of the values by name so a dict is far cheaper than the DataFrame
+    # The description column is never used, so there's no need to parse it, and the values
+    # are all numeric so we give the dtype rather than having pandas infer it.
+    smry = pd.read_csv(analysis_csv, sep=",", skiprows=2, names=["name", "val", "desc"],
+                       usecols=["name", "val"], dtype={ "name": str, "val": np.float64 },
+                       index_col="name", engine="c")["val"].to_dict()
 
     t0 = read_analysis_value(smry, "t_mean")
     period = read_analysis_value(smry, "period", "p_err")
     eclipse_times = []
     eclipse_durations = []
+    warnings = []
 
     if t0:
         # We need both timings and durations for an eclipse in order to be able to use it
@@ -103,42 +327,32 @@ def parse_analysis_for_eclipses(analysis_csv: Path,
                     eclipse_times.append(t0 + eclipse_offset_time)
                 else:
                     eclipse_times.append(eclipse_offset_time)
-                eclipse_durations.append((t4 - t1) * duration_scale)
-            elif verbose:
-                print(f"Cannot derive the eclipse timing/duration for {key}:",
-                      f"at least on of {key} values was not found in the analysis summary.")     
-    elif verbose:
-        print( "Cannot derive any eclipse timings as t0 is not set in the analysis summary.")
-
-    if verbose:
-        print(f"From {analysis_csv.name}")
-        print( "Reference time:             ", (f"{t0:.6f}" if t0 else ""))
-        print( "Orbital period:             ", (f"{period:.6f}" if period else ""))
-        print( "Eclipse times:              ", ", ".join(f"{t:.6f}" for t in eclipse_times))
-        print( "Eclipse durations:          ", ", ".join(f"{t:.6f}" for t in eclipse_durations))
-        if duration_scale != 1.:
-            print(f"Eclipse durations scaled by: {duration_scale}")
-        if any(t.nominal_value == 0 for t in eclipse_durations):
-            print("At least one eclipse duration is zero. Were eclipses found?")
+                eclipse_durations.append(t4 - t1)
+            else:
+                warnings.append(f"Cannot derive the eclipse timing/duration for {key}: at least "
+                                f"on of {key} values was not found in the analysis summary.")
+    else:
+        warnings.append("Cannot derive any eclipse timings as t0 is not set "
+                        "in the analysis summary.")
 
-    return t0, period, eclipse_times, eclipse_durations
+    return t0, period, eclipse_times, eclipse_durations, warnings
 
 
-def read_analysis_value(summary: pd.DataFrame, nominal_key: str, err_key: str=None) \
+def read_analysis_value(summary: Dict[str, float], nominal_key: str, err_key: str=None) \
         -> Union[UFloat, None]:
     """
     Read a value and errorbar from the analysis summary.
 
-    :summary: the analysis summary DataFrame - should be indexed on "name"
+    :summary: the analysis summary values dict - keyed on "name"
     :nominal_key: the nominal name to lookup
-    :err_key: the error index name - if omitted will default to nominal_key with _err suffix
+    :err_key: the error name - if omitted will default to nominal_key with _err suffix
     :returns: an uncertainties ufloat with the requested value or None if not found
     """
-    nom = summary.loc[nominal_key]["val"] if nominal_key in summary.index else None
+    nom = summary.get(nominal_key)
     if nom:
         if not err_key:
             err_key = nominal_key + "_err"
-        err = abs(summary.loc[err_key]["val"] if err_key in summary.index else 0)
+        err = abs(summary.get(err_key, 0))
     return ufloat(nom, err) if nom else None
 
 
@@ -178,95 +392,183 @@ def flatten_lightcurve(lc: LightCurve,
                        eclipse_durations: List[UFloat],
                        orbital_period: UFloat,
                        verbose: bool=True) \
-                            -> Tuple[LightCurve, LightCurve, List[bool]]:
+                            -> Tuple[LightCurve, np.ndarray, np.ndarray]:
     """
-    This will produce a flattened copy of the source LightCurve and a further
-    LightCurve giving the difference between the source and flattened LC.
+    This will produce a flattened copy of the source LightCurve and the residual
+    flux values giving the difference between the source and flattened LC.
 
     :lc: the source LightCurve
     :eclipse_times: reference central times for the eclipse masks
     :eclipse_durations: eclipse durations for the the eclipse masks
     :orbital_period: the orbital period of the system
-    :returns: a tuple in the form (flat_lc, residual_lc, eclipse_mask)
+    :returns: a tuple in the form (flat_lc, residual_flux, eclipse_mask)
     """
-    # Work out the eclipse mask for this sector
-    eclipse_mask = lc.create_transit_mask(
-        transit_time=[t.nominal_value for t in eclipse_times],
-        duration=[t.nominal_value for t in eclipse_durations],
-        period=[orbital_period.nominal_value] * len(eclipse_times))
+    # Work out the eclipse mask for this sector. The nominal values go straight into ndarrays
+    # rather than via intermediate lists.
+    count = len(eclipse_times)
+    eclipse_mask = create_eclipse_mask(
+        lc.time.value,
+        np.fromiter((t.nominal_value for t in eclipse_times), float, count),
+        np.fromiter((t.nominal_value for t in eclipse_durations), float, count),
+        orbital_period.nominal_value)
 
     # Flatten the source lc, except the masked time regions, then find the difference
     if verbose and not any(eclipse_mask):
         print("There are no masked eclipses so flatten will apply over the whole lightcurve")
     flat_lc = lc.flatten(mask=eclipse_mask)
-    res_lc = lc - flat_lc
 
-    return (flat_lc, res_lc, eclipse_mask)
+    # Only the residual flux values are needed, so we don't build a whole residual LightCurve
+    res_flux = lc.flux - flat_lc.flux
+    if hasattr(res_flux, "mask"): # matplotlib & numba don't handle astropy Masked arrays well
+        res_flux = res_flux.filled(np.nan)
+
+    return (flat_lc, res_flux.value, eclipse_mask)
+
+
+def create_eclipse_mask(times: np.ndarray,
+                        eclipse_times: np.ndarray,
+                        eclipse_durations: np.ndarray,
+                        orbital_period: float) -> np.ndarray:
+    """
+    Creates a mask which is True for those times within any of the periodic eclipses.
+    Equivalent to LightCurve.create_transit_mask() for eclipses sharing a single period,
+    without its argument handling and conversions which are unnecessary here.
+
+    :times: the time values to be masked
+    :eclipse_times: reference central times of the eclipses
+    :eclipse_durations: the durations of the eclipses
+    :orbital_period: the orbital period of the system
+    :returns: the boolean mask array, the same length as times
+    """
+    half_period = 0.5 * orbital_period
+    eclipse_mask = np.zeros(len(times), dtype=bool)
+    for eclipse_time, duration in zip(eclipse_times, eclipse_durations):
+        phases = (times - eclipse_time + half_period) % orbital_period - half_period
+        eclipse_mask |= np.abs(phases) < 0.5 * duration
+    return eclipse_mask
 
 
 def plot_lightcurves_and_mask(lc: LightCurve,
                               flat_lc: LightCurve,
-                              residuals_lc: LightCurve,
+                              residual_flux: np.ndarray,
                               eclipse_mask: any,
                               fig_size: Tuple[float, float]=(8, 6),
-                              suptitle: str=None) \
+                              suptitle: str=None,
+                              axes: List[Axes]=None) \
                                     -> Tuple[Figure, Axes]:
     """
     Will create a figure with 3 axes on which it will plot the lc, flat_lc and
-    residual_ls in turn. The eclipse mask will be highlighted on each ax.
+    residual flux in turn. The eclipse mask will be highlighted on each ax.
+    Alternatively, the axes from a previous call may be given to be cleared and
+    reused, saving the cost of creating a new figure each time.
 
     :lc: the source LightCurve
     :flat_lc: the flattened equivalent
-    :residuals_lc: the difference between the source and flattened LightCurves
+    :residual_flux: the difference between the source and flattened LightCurves' fluxes
     :eclipse_mask: the mask used to exclude eclipses from flattening
     :fig_size: the size of the figure to create
     :suptitle: optional suptitle to give the whole figure
-    :returns: a tuple containing the new (figure, axes)
+    :axes: optional axes, from a previous call, to reuse; fig_size is ignored if given
+    :returns: a tuple containing the new or reused (figure, axes)
     """
     # pylint: disable=too-many-arguments
-    gridspec_kw = { "height_ratios": [4, 4, 2] }
-    fig, axes = plt.subplots(3, 1, sharex="all", figsize=fig_size,
-                             gridspec_kw=gridspec_kw, constrained_layout=True)
+    if axes is None:
+        gridspec_kw = { "height_ratios": [4, 4, 2] }
+        fig, axes = plt.subplots(3, 1, sharex="all", figsize=fig_size,
+                                 gridspec_kw=gridspec_kw, constrained_layout=True)
+    else:
+        fig = axes[0].figure
+        for ax in axes:
+            ax.cla()
     if suptitle:
         fig.suptitle(suptitle)
 
-    # We plot the input LC to the upper ax, the flattened in the middle
-    # and the residuals on the lower ax
-    lc.scatter(ax=axes[0], marker=".", s=0.5, label=None)
-    axes[0].set_xlabel(None)
-
-    flat_lc.scatter(ax=axes[1], marker=".", s=0.5, label=None)
-    axes[1].set_xlabel(None)
-
-    residuals_lc.scatter(ax=axes[2], marker=".", s=0.5, label=None)
+    # We plot the input LC to the upper ax, the flattened in the middle and the residuals on
+    # the lower ax. The raw arrays are plotted directly, rather than with LightCurve.scatter(),
+    # to skip its label, legend and style handling which we would only go on to override.
+    times = lc.time.value
+    for ax, flux in zip(axes, [lc.flux, flat_lc.flux]):
+        if hasattr(flux, "mask"): # matplotlib doesn't handle astropy Masked arrays well
+            flux = flux.filled(np.nan)
+        ax.scatter(times, flux.value, marker=".", s=0.5)
+    axes[2].scatter(times, residual_flux, marker=".", s=0.5)
+
+    flux_label = "Normalized Flux" if lc.meta.get("NORMALIZED") else "Flux"
+    axes[0].set_ylabel(flux_label)
+    axes[1].set_ylabel(flux_label)
     axes[2].set_ylabel("Residual")
+    if lc.time.format == "btjd":
+        axes[2].set_xlabel("Time - 2457000 [BTJD days]")
+    else:
+        axes[2].set_xlabel(f"Time [{lc.time.format.upper()}]")
 
     # The eclipse masks will be highlighted on all axes. To do this we need
     # the start/end times of each mask. It's a bit tortuous so to doc the algo;
-    # clump_masked gets us slices oover each contiguous region of the masked
-    # data then the slices' start/stop can be used as indices to the values.
-    mask_slices = np.ma.clump_masked(np.ma.masked_where(eclipse_mask, lc.time.value))
-    transform = axes[0].get_xaxis_transform()
-    for t1, t4 in ((lc.time[s.start].value, lc.time[s.stop-1].value) for s in mask_slices):
-        for ax in axes:
-            ax.axvspan(t1, t4, color="lightgray", zorder=-10, transform=transform)
+    # diffing the mask, padded with False at either end, gives the edges of each
+    # contiguous masked region which alternate between the starts & (exclusive) stops.
+    edges = np.flatnonzero(np.diff(np.asarray(eclipse_mask, dtype=np.int8), prepend=0, append=0))
+    t1s, t4s = times[edges[0::2]], times[edges[1::2]-1]
+
+    # Each span is a full height rectangle (in axes coords) from t1 to t4. Rather than an
+    # axvspan patch per span & ax, the spans go into a single PolyCollection on each ax.
+    verts = np.empty((len(t1s), 4, 2), dtype=float)
+    verts[:, :, 0] = np.column_stack([t1s, t1s, t4s, t4s])
+    verts[:, :, 1] = [0, 1, 1, 0]
+    for ax in axes:
+        ax.add_collection(PolyCollection(verts, color="lightgray", zorder=-10,
+                                         transform=ax.get_xaxis_transform()), autolim=False)
 
     return fig, axes
 
 
-def calculate_variability_metric(residual_lc: LightCurve) -> float:
+def calculate_variability_metric(residual_flux: np.ndarray) -> float:
     """
     Calculates a metric which summarizes the amount of variability in the
-    passed LightCurve.
+    passed flux values.
 
     The metric is given by 2 * interquartile_range(flux).
     The higher the value the greater the variability.
 
-    :residual_lc: the source LightCurve - ideally the residual after removing eclipses
+    :residual_flux: the source flux values - ideally the residual after removing eclipses
     :returns: a single floating point metric giving the degree of variability
     """
     # We just use the nominal value of the residual flux for now - it gives the indication required.
     # I've tried this with ufloats on flux and flux_err but the results are inconsistent with
     # some sectors reporting an order of magnitude lower variability than other similar ones.
-    fluxes = residual_lc.flux.value.tolist()
-    return iqr(fluxes, nan_policy="omit", interpolation="linear") * 2
+    fluxes = np.asarray(residual_flux, dtype=np.float64)
+    return nan_iqr(fluxes) * 2
+
+
+@njit(cache=True)
+def nan_iqr(values: np.ndarray) -> float:
+    """
+    Calculates the interquartile range of the passed values, ignoring any NaNs.
+    Gives the same result as scipy's iqr(values, nan_policy="omit", interpolation="linear")
+    but selects the quartiles with partitions rather than sorting all the values.
+
+    :values: the 1d array of values
+    :returns: the interquartile range or NaN if there are no non-NaN values
+    """
+    # Compact the non-NaN values into a scratch buffer
+    buffer = np.empty(values.size, dtype=np.float64)
+    count = 0
+    for value in values:
+        if not np.isnan(value):
+            buffer[count] = value
+            count += 1
+    if count == 0:
+        return np.nan
+    buffer = buffer[:count]
+
+    quartiles = np.empty(2, dtype=np.float64)
+    for i, quantile in enumerate((0.25, 0.75)):
+        # Linear interpolation between the values either side of the quantile's fractional rank
+        rank = (count - 1) * quantile
+        lower_ix = int(np.floor(rank))
+        fraction = rank - lower_ix
+        partitioned = np.partition(buffer, lower_ix)
+        quartiles[i] = partitioned[lower_ix]
+        if fraction > 0:
+            upper = np.min(partitioned[lower_ix+1:])
+            quartiles[i] += (upper - quartiles[i]) * fraction
+    return quartiles[1] - quartiles[0]